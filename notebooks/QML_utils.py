@@ -1,15 +1,48 @@
-from qiskit.circuit import QuantumCircuit, QuantumRegister, ParameterVector
+from qiskit.circuit import QuantumCircuit, QuantumRegister, Parameter, ParameterVector, ParameterExpression
 from qiskit.circuit.library import NLocal
 from qiskit.circuit.library.standard_gates import RYGate, RZGate, RXGate
-from qiskit import ClassicalRegister, QuantumRegister
+from qiskit import ClassicalRegister
 from qiskit.providers.aer import AerSimulator
-from qiskit import transpile, assemble
+from qiskit import transpile
 
+import functools
+import inspect
 import numpy as np
 
 
 #__all__ = ['UnitaryNlocal4', 'UnitaryNlocal2', 'CU2Nlocal', 'UniformControl2']
 
+rng = np.random.default_rng()
+
+def cached_template(factory):
+    '''
+    Decorator for the circuit factories. The circuit is built once for every 
+    combination of the structural arguments (all but name and parameter_prefix),
+    later calls copy the cached template and rename its parameters 
+    with the requested parameter_prefix.
+    '''
+    signature = inspect.signature(factory)
+
+    @functools.lru_cache(maxsize=None)
+    def template(**kwargs):
+        return factory(**kwargs)
+
+    @functools.wraps(factory)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        name = bound.arguments.pop('name')
+        parameter_prefix = bound.arguments.pop('parameter_prefix')
+        key = {k: tuple(v) if isinstance(v, list) else v for k, v in bound.arguments.items()}
+        circ = template(**key)
+        params = ParameterVector(parameter_prefix, circ.num_parameters)
+        circ = circ.assign_parameters({p: params[p.index] for p in circ.parameters})
+        circ.name = name
+        return circ
+
+    return wrapper
+
+@cached_template
 def UnitaryNlocal4(reps=3, name='U4', parameter_prefix='u4_x'):
     '''
     A utility function to create a parameterized Nlocal circuit 
@@ -30,7 +63,7 @@ def UnitaryNlocal4(reps=3, name='U4', parameter_prefix='u4_x'):
         
     Return
     ------
-    Qiskit BlueprintCircuit, the Nlocal citcuit
+    Qiskit QuantumCircuit, the decomposed Nlocal citcuit
     '''
     # rotation block:
     rot = QuantumCircuit(2)
@@ -52,9 +85,12 @@ def UnitaryNlocal4(reps=3, name='U4', parameter_prefix='u4_x'):
                        entanglement_blocks=ent, entanglement='linear',
                        skip_final_rotation_layer=True, insert_barriers=True)
     
-    return qc_nlocal
+    # flatten the BlueprintCircuit, so binding and transpiling
+    # don't have to recurse into the nested definitions
+    return qc_nlocal.decompose()
 
 
+@cached_template
 def UnitaryNlocal2(reps=2, name='U2', parameter_prefix='u2_x'):
     '''
     A utility function to create a parameterized Nlocal circuit 
@@ -76,7 +112,7 @@ def UnitaryNlocal2(reps=2, name='U2', parameter_prefix='u2_x'):
         
     Return
     ------
-    Qiskit BlueprintCircuit, the Nlocal citcuit
+    Qiskit QuantumCircuit, the decomposed Nlocal citcuit
     '''
     # rotation block:
     rot = QuantumCircuit(2)
@@ -98,8 +134,9 @@ def UnitaryNlocal2(reps=2, name='U2', parameter_prefix='u2_x'):
                        parameter_prefix=parameter_prefix,
                        entanglement_blocks=ent, entanglement='linear',
                        skip_final_rotation_layer=True, insert_barriers=True)
-    return qc_nlocal
+    return qc_nlocal.decompose()
 
+@cached_template
 def CU2Nlocal(controlbit=[1,1], reps=2, name='Ut', parameter_prefix='CU2_x'):
     '''
     A utility function to create a parameterized Nlocal circuit 
@@ -125,57 +162,23 @@ def CU2Nlocal(controlbit=[1,1], reps=2, name='Ut', parameter_prefix='CU2_x'):
         
     Return
     ------
-    Qiskit BlueprintCircuit, the Nlocal citcuit
+    Qiskit QuantumCircuit, the decomposed Nlocal citcuit
     '''
     # Rotation Block
     params = ParameterVector('r', 4)
-
-    qr=QuantumRegister(3, name='q')
-    circ1=QuantumCircuit(3) 
-    CCRY=RYGate(params[0]).control(2) 
-    CCRZ=RZGate(params[1]).control(2)
-    circ1.append(CCRY, qr)
-    circ1.append(CCRZ, qr)
-
-    qr=QuantumRegister(3, name='q')
-    circ2=QuantumCircuit(3) 
-    CCRY=RYGate(params[2]).control(2) 
-    CCRZ=RZGate(params[3]).control(2)
-    circ2.append(CCRY, qr)
-    circ2.append(CCRZ, qr)
-
     rot = QuantumCircuit(4)
-    rot.append(circ1, [0,1,2])
-    rot.append(circ2, [0,1,3])
+    rot.append(RYGate(params[0]).control(2), [0,1,2])
+    rot.append(RZGate(params[1]).control(2), [0,1,2])
+    rot.append(RYGate(params[2]).control(2), [0,1,3])
+    rot.append(RZGate(params[3]).control(2), [0,1,3])
 
     # entanglement block:
     params = ParameterVector('e', 4)
     ent = QuantumCircuit(4)
-
-    qr=QuantumRegister(4, name='q')
-    circ1=QuantumCircuit(4)
-    C3RX=RXGate(params[0]).control(3)
-    circ1.append(C3RX, qr)
-
-    qr=QuantumRegister(4, name='q')
-    circ2=QuantumCircuit(4)
-    C3RX=RXGate(params[1]).control(3)
-    circ2.append(C3RX, qr)
-
-    qr=QuantumRegister(4, name='q')
-    circ3=QuantumCircuit(4)
-    C3RX=RXGate(params[2]).control(3)
-    circ3.append(C3RX, qr)
-
-    qr=QuantumRegister(4, name='q')
-    circ4=QuantumCircuit(4)
-    C3RX=RXGate(params[3]).control(3)
-    circ4.append(C3RX, qr)
-
-    ent.append(circ1,[0,1,2,3])
-    ent.append(circ2,[0,1,3,2])
-    ent.append(circ3,[0,1,2,3])
-    ent.append(circ4,[0,1,3,2])
+    ent.append(RXGate(params[0]).control(3), [0,1,2,3])
+    ent.append(RXGate(params[1]).control(3), [0,1,3,2])
+    ent.append(RXGate(params[2]).control(3), [0,1,2,3])
+    ent.append(RXGate(params[3]).control(3), [0,1,3,2])
 
     qc_nlocal = NLocal(num_qubits=4, rotation_blocks=rot, reps=reps, name=name, 
                        parameter_prefix=parameter_prefix,
@@ -192,14 +195,18 @@ def CU2Nlocal(controlbit=[1,1], reps=2, name='Ut', parameter_prefix='CU2_x'):
         before.x(1)
         after.x(1)
     
+    # the X bookends are empty when all the control bits are 1, skip them 
+    # together with their barriers
     CU2 = QuantumCircuit(4)
-    CU2.append(before,[0,1])
-    CU2.barrier()
-    CU2.append(qc_nlocal,[0,1,2,3])
-    CU2.barrier()
-    CU2.append(after, [0,1])
+    if len(before.data):
+        CU2.compose(before, qubits=[0,1], inplace=True)
+        CU2.barrier()
+    CU2.compose(qc_nlocal, qubits=[0,1,2,3], inplace=True)
+    if len(after.data):
+        CU2.barrier()
+        CU2.compose(after, qubits=[0,1], inplace=True)
     
-    return CU2
+    return CU2.decompose()
 
 def UniformControl2(reps=3, name='Ut', parameter_prefix='Ut_x'):
     '''
@@ -211,13 +218,13 @@ def UniformControl2(reps=3, name='Ut', parameter_prefix='Ut_x'):
     CU00 = CU2Nlocal(controlbit=[0,0], reps=reps, name=name+'_4', parameter_prefix=parameter_prefix+'_4')
     
     UCU2 = QuantumCircuit(4)
-    UCU2.append(CU11, [0,1,2,3])
+    UCU2.compose(CU11, qubits=[0,1,2,3], inplace=True)
     UCU2.barrier()
-    UCU2.append(CU01, [0,1,2,3])
+    UCU2.compose(CU01, qubits=[0,1,2,3], inplace=True)
     UCU2.barrier()
-    UCU2.append(CU10, [0,1,2,3])
+    UCU2.compose(CU10, qubits=[0,1,2,3], inplace=True)
     UCU2.barrier()
-    UCU2.append(CU00, [0,1,2,3])
+    UCU2.compose(CU00, qubits=[0,1,2,3], inplace=True)
     
     return UCU2
 
@@ -232,65 +239,253 @@ def Create_BBQC4():
     Uo4 = UnitaryNlocal4(reps=3, name=r"$U_o^{(4)}$", parameter_prefix=r"$U_o^{(4)}$")
     Ut4 = UniformControl2(reps=2, name=r"$U_t^{(4)}$", parameter_prefix=r"$U_t^{(4)}x$")
     BBQC = QuantumCircuit(QuantumRegister(16), ClassicalRegister(8))
-    BBQC.append(Up, [0,1])
-    BBQC.append(Ut2, [0,1,4,5])
-    BBQC.append(Ut3, [4,5,8,9])
-    BBQC.append(Ut4, [8,9,12,13])
-    BBQC.append(Uo1, [0,1,2,3])
-    BBQC.append(Uo2, [4,5,6,7])
-    BBQC.append(Uo3, [8,9,10,11])
-    BBQC.append(Uo4, [12,13,14,15])
+    BBQC.compose(Up, qubits=[0,1], inplace=True)
+    BBQC.compose(Ut2, qubits=[0,1,4,5], inplace=True)
+    BBQC.compose(Ut3, qubits=[4,5,8,9], inplace=True)
+    BBQC.compose(Ut4, qubits=[8,9,12,13], inplace=True)
+    BBQC.compose(Uo1, qubits=[0,1,2,3], inplace=True)
+    BBQC.compose(Uo2, qubits=[4,5,6,7], inplace=True)
+    BBQC.compose(Uo3, qubits=[8,9,10,11], inplace=True)
+    BBQC.compose(Uo4, qubits=[12,13,14,15], inplace=True)
     BBQC.measure([2,3,6,7,10,11,14,15], [0,1,2,3,4,5,6,7])
     return BBQC
 
+GENE_LUT = np.array(['00', '01', '10', '11'])
+
+def as_genes(genelist):
+    '''
+    Convert genes to an integer array, raise ValueError if any gene is 
+    not an integer in 0-3
+    '''
+    genes = np.asarray(genelist)
+    if genes.size == 0:
+        return genes.astype(np.intp)
+    if not (np.issubdtype(genes.dtype, np.integer) or 
+            (np.issubdtype(genes.dtype, np.floating) and np.all(genes == np.round(genes)))):
+        raise ValueError("genes should be integers, got {}".format(genelist))
+    genes = genes.astype(np.intp)
+    if genes.min() < 0 or genes.max() > 3:
+        raise ValueError("genes should be in 0-3, got {}".format(genelist))
+    return genes
+
 def convert_str(genelist):
-    output = ""
-    for i in genelist:
-        if i == 0:
-            output += '00'
-        if i == 1:
-            output += '01'
-        if i == 2:
-            output += '10'
-        if i == 3:
-            output += '11'
-    return output
+    genes = as_genes(genelist)
+    if genes.ndim != 1:
+        raise ValueError("convert_str takes a single gene sequence, use convert_int for a 2D array")
+    return ''.join(GENE_LUT[genes])
+
+def convert_int(genelist):
+    '''
+    Integer encoding of the gene sequence, equal to int(convert_str(genelist), 2).
+    A 2D array of sequences is encoded row by row, so a whole dataset can be 
+    converted at once and used directly as a databatch.
+    '''
+    genes = as_genes(genelist).astype(np.int64)
+    shifts = 2*np.arange(genes.shape[-1])[::-1]
+    return (genes << shifts).sum(axis=-1)
     
-def measure_result(BBQC, simulator, x, n_shots=1000):
-    value_dict = dict(zip(BBQC.parameters, x))
-    tcirc = transpile(BBQC, simulator)
-    qobj = assemble(tcirc, shots=n_shots, parameter_binds = [value_dict])
-    result = simulator.run(qobj).result()
-    return result.get_counts()
-
-def NLL(counts, databatch, n_shots=1000):
-    NLL = 0.
-    for i in databatch:
-        temp = counts.get(i)
-        if temp is None:
-            NLL += 2*np.log2(n_shots)
-        else:
-            NLL += -np.log2(temp/n_shots)
-    return NLL/len(databatch)
-
-def gradient(x, databatch, BBQC, simulator, n_shots=1000, eps=0.2):
-    epsilon = eps*2*np.pi*np.random.uniform(size=BBQC.num_parameters)
-    countsplus = measure_result(BBQC, simulator, x+epsilon, n_shots=n_shots)
-    countsminus = measure_result(BBQC, simulator, x-epsilon, n_shots=n_shots)
-    counts = measure_result(BBQC, simulator, x, n_shots=n_shots)
-    NLL_plus = NLL(countsplus, databatch)
-    NLL_minus = NLL(countsminus, databatch)
-    FD_dfdx = (NLL_plus - NLL_minus)/2*epsilon
-    NLL_x =  NLL(counts, databatch)
+def measure_results(tcirc, simulator, xs, n_shots=1000):
+    '''
+    Run the parameterized circuit on the simulator for every set of 
+    parameter values in xs, all within a single job.
+    tcirc should be transpiled once with `transpile(BBQC, simulator)` and
+    reused, only the parameter values are bound at each run.
+    
+    Return
+    ------
+    list of counts dict, one for each row of xs
+    '''
+    xs = np.asarray(xs)
+    value_dict = {p: xs[:, i].tolist() for i, p in enumerate(tcirc.parameters)}
+    result = simulator.run(tcirc, shots=n_shots, parameter_binds=[value_dict]).result()
+    return [result.get_counts(k) for k in range(len(xs))]
+
+def measure_result(tcirc, simulator, x, n_shots=1000):
+    return measure_results(tcirc, simulator, [x], n_shots=n_shots)[0]
+
+def encode_batch(databatch):
+    '''
+    Encode a batch of measurement bitstrings as integers, 
+    integer batches are returned untouched
+    '''
+    databatch = np.asarray(databatch)
+    if np.issubdtype(databatch.dtype, np.integer):
+        return databatch
+    return np.fromiter((int(s, 2) for s in databatch), dtype=np.int64, count=len(databatch))
+
+def batch_probs(counts, databatch, n_shots=1000, n_bits=8):
+    '''
+    Sampled probabilities of the outcomes in databatch
+    '''
+    idx = encode_batch(databatch)
+    cvec = np.zeros(2**n_bits, dtype=np.int64)
+    for k, v in counts.items():
+        cvec[int(k, 2)] = v
+    return cvec[idx]/n_shots
+
+def NLL(counts, databatch, n_shots=1000, n_bits=8):
+    p = batch_probs(counts, databatch, n_shots=n_shots, n_bits=n_bits)
+    nll = np.where(p == 0, 2*np.log2(n_shots), -np.log2(np.maximum(p, 1/n_shots)))
+    return nll.mean()
+
+def controlled_parameters(BBQC):
+    '''
+    Boolean mask over BBQC.parameters, True for the parameters feeding 
+    controlled rotations (crx, C2RY, C2RZ, C3RX), False for the single-qubit ones.
+    So the mask doesn't depend on how far the circuit is decomposed, a parameter
+    also counts as controlled when it enters a gate through an expression 
+    (e.g. theta/2) or appears in more than one instruction, as it does once 
+    the controlled rotations are broken down into their definitions.
+    '''
+    controlled = set()
+    seen = set()
+    for inst, qargs, cargs in BBQC.data:
+        for param in inst.params:
+            if not isinstance(param, ParameterExpression):
+                continue
+            if len(qargs) > 1 or not isinstance(param, Parameter):
+                controlled |= param.parameters
+            controlled |= param.parameters & seen
+            seen |= param.parameters
+    return np.array([p in controlled for p in BBQC.parameters])
+
+# four-term shift rule for the controlled rotations, whose generators have 
+# eigenvalues {0, +-1/2}
+SHIFT_1, SHIFT_2 = np.pi/2, 3*np.pi/2
+COEF_1, COEF_2 = (np.sqrt(2)+1)/(4*np.sqrt(2)), (np.sqrt(2)-1)/(4*np.sqrt(2))
+
+def gradient(x, databatch, tcirc, simulator, n_shots=1000, controlled=None, xs=None):
+    '''
+    Parameter-shift gradient of the NLL. The shift rules give the derivatives
+    of the batch outcome probabilities, which are chain-ruled into the NLL,
+    dNLL/dx = -mean(dp/dx / p)/ln2. Single-qubit rotations use the two-term
+    rule (shift pi/2), controlled rotations the four-term rule (shifts pi/2 
+    and 3pi/2). The probabilities are sampled, so the result is still a 
+    shot-noise estimate. Outcomes never seen at x contribute 0, as NLL counts 
+    them with the constant penalty 2*log2(n_shots).
+    
+    All the 2P+2C+1 parameter sets (C controlled parameters) are run in a 
+    single job, over 750 circuits for BBQC, use spsa_gradient for a cheap 
+    estimate.
+    
+    controlled: optional boolean array of shape (P,), from controlled_parameters(BBQC),
+        default treats every parameter as controlled, the four-term rule being 
+        valid for the single-qubit rotations too
+    
+    xs: optional array of shape (2P+2C+1, P), preallocated buffer for the 
+        parameter sets, so repeated calls don't allocate it every time
+    
+    Return
+    ------
+    dfdx: array of shape (P,), the gradient estimate
+    NLL_x: float, the NLL at x
+    '''
+    n = len(x)
+    if controlled is None:
+        controlled = np.ones(n, dtype=bool)
+    c = np.flatnonzero(controlled)
+    m = len(c)
+    if xs is None:
+        xs = np.empty((2*n+2*m+1, n))
+    xs[:] = x
+    idx = np.arange(n)
+    xs[1+idx, idx] += SHIFT_1
+    xs[1+n+idx, idx] -= SHIFT_1
+    xs[1+2*n+np.arange(m), c] += SHIFT_2
+    xs[1+2*n+m+np.arange(m), c] -= SHIFT_2
+    counts = measure_results(tcirc, simulator, xs, n_shots=n_shots)
+    databatch = encode_batch(databatch)
+    P = np.array([batch_probs(cnt, databatch, n_shots=n_shots) for cnt in counts])
+    diff_1 = P[1:n+1] - P[n+1:2*n+1]
+    diff_2 = P[2*n+1:2*n+m+1] - P[2*n+m+1:]
+    dp = diff_1/2
+    dp[c] = COEF_1*diff_1[c] - COEF_2*diff_2
+    dlogp = np.divide(dp, P[0], out=np.zeros_like(dp), where=P[0] > 0)
+    dfdx = -dlogp.mean(axis=1)/np.log(2)
+    NLL_x = NLL(counts[0], databatch, n_shots=n_shots)
+    return dfdx, NLL_x
+
+def spsa_gradient(x, databatch, tcirc, simulator, n_shots=1000, eps=0.2, xs=None, epsilon=None, out=None, rng=rng):
+    '''
+    SPSA estimate of the NLL gradient. All parameters are perturbed at once
+    by +/- eps*2*pi with random signs, so only the two parameter sets 
+    x +/- epsilon are run, in a single job.
+    
+    xs: optional array of shape (2, P), preallocated buffer for the 
+        parameter sets, so repeated calls don't allocate it every time
+    
+    epsilon, out: optional arrays of shape (P,), preallocated buffers for the 
+        perturbation and the returned gradient
+    
+    rng: numpy Generator, default the module level rng
+        source of the random signs, pass a seeded one for reproducible runs
+    
+    Return
+    ------
+    dfdx: array of shape (P,), the gradient estimate
+    NLL_x: float, mean of the NLL at x +/- epsilon, a proxy for the NLL at x
+    '''
+    n = len(x)
+    if xs is None:
+        xs = np.empty((2, n))
+    if epsilon is None:
+        epsilon = np.empty(n)
+    if out is None:
+        out = np.empty(n)
+    # random signs from uniform samples in place, copysign never gives 0
+    rng.random(out=epsilon)
+    epsilon -= 0.5
+    np.copysign(eps*2*np.pi, epsilon, out=epsilon)
+    np.add(x, epsilon, out=xs[0])
+    np.subtract(x, epsilon, out=xs[1])
+    countsplus, countsminus = measure_results(tcirc, simulator, xs, n_shots=n_shots)
+    databatch = encode_batch(databatch)
+    NLL_plus = NLL(countsplus, databatch, n_shots=n_shots)
+    NLL_minus = NLL(countsminus, databatch, n_shots=n_shots)
+    FD_dfdx = np.divide(NLL_plus - NLL_minus, epsilon, out=out)
+    FD_dfdx /= 2
+    NLL_x = 0.5*(NLL_plus + NLL_minus)
     return FD_dfdx, NLL_x
 
-def training(initial_x, traindata, BBQC, similator, batchsize=8, n_steps=50, loss_track=[], alpha=0.01):
+def training(initial_x, traindata, BBQC, simulator, batchsize=8, n_steps=50, loss_track=[], alpha=0.01, method='spsa', rng=rng):
+    '''
+    method: str, default 'spsa'
+        'spsa' for the cheap SPSA estimate with two circuit evaluations per step,
+        'shift' for the parameter-shift gradient, with 2P+2C+1 evaluations per step
+    
+    rng: numpy Generator, default the module level rng
+        used to draw the batches and the SPSA perturbations, 
+        pass np.random.default_rng(seed) for reproducible runs
+    '''
     N = len(traindata)
-    x = initial_x
+    x = np.array(initial_x, dtype=float)
+    if method == 'spsa':
+        grad = functools.partial(spsa_gradient, rng=rng, 
+                                 epsilon=np.empty(len(x)), out=np.empty(len(x)))
+        xs = np.empty((2, len(x)))
+    elif method == 'shift':
+        controlled = controlled_parameters(BBQC)
+        n_rows = 2*len(x) + 2*controlled.sum() + 1
+        grad = functools.partial(gradient, controlled=controlled)
+        xs = np.empty((n_rows, len(x)))
+    else:
+        raise ValueError("method should be 'spsa' or 'shift', got {}".format(method))
+    tcirc = transpile(BBQC, simulator)
     for i in range(n_steps):
-        I = np.random.choice(N, size=batchsize)
+        I = rng.integers(N, size=batchsize)
         databatch = traindata[I]
-        dfdx, NLL_x = gradient(x, databatch, BBQC, simulator)
+        dfdx, NLL_x = grad(x, databatch, tcirc, simulator, xs=xs)
         loss_track.append(NLL_x)
-        x = x - alpha * dfdx  
-    return x, loss_track
\ No newline at end of file
+        dfdx *= alpha
+        x -= dfdx
+    return x, loss_track
+
+
+if __name__ == '__main__':
+    # sanity check of the gradient setup: BBQC has 80 crx parameters (U_p and 
+    # U_o) and 192 C2RY/C2RZ/C3RX parameters (U_t), the other 104 are ry/rz
+    BBQC = Create_BBQC4()
+    controlled = controlled_parameters(BBQC)
+    assert BBQC.num_parameters == 376, BBQC.num_parameters
+    assert controlled.sum() == 272, controlled.sum()
+    print('controlled_parameters: {} of {} parameters'.format(controlled.sum(), BBQC.num_parameters))